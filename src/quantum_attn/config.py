@@ -31,6 +31,11 @@ class attention:
     enable_triton_tma_kernel = os.getenv("QUANTUM_ATTN_ENABLE_TRITON_TMA_KERNEL") == "1"
 
 
+class tk:
+    line_info = os.getenv("QUANTUM_ATTN_TK_LINE_INFO") == "1"
+    kernel_stats = os.getenv("QUANTUM_ATTN_TK_KERNEL_STATS") == "1"
+
+
 try:
     from torch.utils._config_module import install_config_module
 except ImportError:
@@ -41,7 +41,7 @@ def tk_attention_forward_kernel(
     assert scale is None
 
     module = load_tk_attention_module(dtype=value.dtype)
-    out = module.attention_forward(query, key, value, is_causal)[0]
+    out = module.attention_forward(query, key, value, is_causal)
     return out
 
 
@@ -69,7 +69,7 @@ def tk_fp8_attention_forward_kernel(
     assert scale is None
 
     module = load_tk_attention_module(dtype=value.dtype, is_fp8=True)
-    out = module.attention_forward(query, key, value, scale_q, scale_k, is_causal)[0]
+    out = module.attention_forward(query, key, value, scale_q, scale_k, is_causal)
     return out
 
 
@@ -937,9 +937,11 @@ def tuned_attention_forward(
 
     query, key, value = (ir.ExternKernel.realize_input(x) for x in (query, key, value))
     if use_tk_tma_kernel:
-        query, key, value = (require_dense_memory(x) for x in (query, key, value))
+        # the TK kernel only addresses contiguous BHSD tensors, so let the producers write that layout
+        # instead of leaving a copy to the extension
+        query, key, value = (ir.ExternKernel.require_contiguous(x) for x in (query, key, value))
         if attn_mask is not None:
-            attn_mask = require_dense_memory(attn_mask)
+            attn_mask = ir.ExternKernel.require_contiguous(attn_mask)
     elif use_triton_tma_kernel:
         query = require_dense_memory(query, num_dims=1)
         key, value = (require_dense_memory(x, num_dims=2) for x in (key, value))
@@ -949,7 +951,7 @@ def tuned_attention_forward(
     if scale_q is not None:
         scale_q, scale_k = (ir.ExternKernel.realize_input(x) for x in (scale_q, scale_k))
         if use_tk_tma_kernel:
-            scale_q, scale_k = (require_dense_memory(x) for x in (scale_q, scale_k))
+            scale_q, scale_k = (ir.ExternKernel.require_contiguous(x) for x in (scale_q, scale_k))
         elif use_triton_tma_kernel:
             scale_q, scale_k = (require_dense_memory(x, num_dims=1) for x in (scale_q, scale_k))
     for x in (query, key, value, scale_q, scale_k, attn_mask):
@@ -1,12 +1,18 @@
 import functools
+import itertools
 import os
 
 import torch
-from torch.utils.cpp_extension import load_inline
+
+from quantum_attn import config
 
 from . import utils
 
-TK_ATTENTION_SOURCE = """
+TK_ATTENTION_KERNEL_SOURCE = """
+#pragma once
+
+#include <torch/types.h>
+
 #include "kittens.cuh"
 #include <cooperative_groups.h>
 #include <iostream>
@@ -46,6 +52,74 @@ template<> __device__ inline float2 fast_exp2::op<float2>(const float2 &x) { ret
 }
 }
 
+// one pass online softmax: new running max, exp2 of the scores, rescaled row sums and the
+// exp2(old_max - new_max) correction for the output accumulator.
+// scores are taken unscaled and scale (>= 0) is applied inside the exp2 argument, max_vec stays unscaled.
+// when mask is set, scores past the causal diagonal (or past kv_len) are dropped during the max pass.
+template<bool is_causal, ducks::rt::row_layout RT, ducks::rv::all V>
+__device__ static inline void online_softmax(RT &att, V &max_vec, V &norm_vec, V &correction, const float scale,
+                                             const bool mask, const int q_row, const int k_col, const int kv_len) {
+    const int row = q_row + kittens::laneid()/4;
+    const int col = k_col + 2*(kittens::laneid()%4);
+
+    #pragma unroll
+    for (int i = 0; i < att.height; i++) {
+        #pragma unroll
+        for (int h = 0; h < 2; h++) {
+            // col vectors pack the top row of a lane in .x and the row 8 below in .y
+            float &max_last = h == 0 ? max_vec.data[i][0].x  : max_vec.data[i][0].y;
+            float &norm     = h == 0 ? norm_vec.data[i][0].x : norm_vec.data[i][0].y;
+            float &corr     = h == 0 ? correction.data[i][0].x : correction.data[i][0].y;
+
+            const int bound = is_causal ? row + i*kittens::TILE_ROW_DIM<float> + h*8 + 1 : kv_len;
+
+            float m = max_last;
+            #pragma unroll
+            for (int j = 0; j < att.width; j++) {
+                #pragma unroll
+                for (int k = h; k < att.packed_per_tile; k += 2) {
+                    if (mask) {
+                        const int c = col + j*kittens::TILE_COL_DIM<float> + (k/2)*8;
+                        att.tiles[i][j].data[k].x = (c   < bound) ? att.tiles[i][j].data[k].x : kittens::base_types::constants<float>::neg_infty();
+                        att.tiles[i][j].data[k].y = (c+1 < bound) ? att.tiles[i][j].data[k].y : kittens::base_types::constants<float>::neg_infty();
+                    }
+                    m = fmaxf(m, fmaxf(att.tiles[i][j].data[k].x, att.tiles[i][j].data[k].y));
+                }
+            }
+            m = fmaxf(m, __shfl_xor_sync(0xffffffff, m, 1));
+            m = fmaxf(m, __shfl_xor_sync(0xffffffff, m, 2));
+
+            const float m_scaled = m * scale;
+            float sum = 0.f;
+            #pragma unroll
+            for (int j = 0; j < att.width; j++) {
+                #pragma unroll
+                for (int k = h; k < att.packed_per_tile; k += 2) {
+                    att.tiles[i][j].data[k].x = fast_exp2f(fmaf(att.tiles[i][j].data[k].x, scale, -m_scaled));
+                    att.tiles[i][j].data[k].y = fast_exp2f(fmaf(att.tiles[i][j].data[k].y, scale, -m_scaled));
+                    sum += att.tiles[i][j].data[k].x + att.tiles[i][j].data[k].y;
+                }
+            }
+            sum += __shfl_xor_sync(0xffffffff, sum, 1);
+            sum += __shfl_xor_sync(0xffffffff, sum, 2);
+
+            // the first block has no previous max, keep -inf * 0 from turning into a NaN
+            corr     = max_last == kittens::base_types::constants<float>::neg_infty() ? 0.f : fast_exp2f((max_last - m) * scale);
+            norm     = norm * corr + sum;
+            max_last = m;
+        }
+    }
+}
+
+template<ducks::rv::all V>
+__device__ static inline void reciprocal(V &dst, const V &src) {
+    #pragma unroll
+    for (int i = 0; i < dst.outer_dim; i++) {
+        dst.data[i][0].x = __frcp_rn(src.data[i][0].x);
+        dst.data[i][0].y = __frcp_rn(src.data[i][0].y);
+    }
+}
+
 template<int D> struct fwd_attend_ker_tile_dims {};
 template<> struct fwd_attend_ker_tile_dims<64> {
     constexpr static int tile_width = (64);
@@ -63,7 +137,7 @@ template<> struct fwd_attend_ker_tile_dims<256> {
     constexpr static int tile_width = (256);
     constexpr static int qo_height  = (4*16);
     constexpr static int kv_height  = (4*16);
-    constexpr static int stages     = (2);
+    constexpr static int stages     = (sizeof(QKDType) == 1 ? 3 : 2);
 };
 
 template<int D> struct fwd_globals {
@@ -92,8 +166,38 @@ template<int D> struct fwd_globals {
 
     const int N;
     const int hr;
+    const int qo_heads;
+    const int num_m_blocks;
+    const int num_tasks;
+};
+
+struct fwd_task {
+    int batch_idx;
+    int head_idx;
+    int seq_idx;
 };
 
+template<int D, bool is_causal, int CONSUMER_WARPGROUPS>
+__device__ static inline fwd_task get_fwd_task(const fwd_globals<D> &g, const int task_id) {
+    int m_block = task_id % g.num_m_blocks;
+    if constexpr (is_causal) {
+        // schedule the longest rows of each head first
+        m_block = g.num_m_blocks - 1 - m_block;
+    }
+    return {task_id / (g.num_m_blocks * g.qo_heads), (task_id / g.num_m_blocks) % g.qo_heads, m_block * CONSUMER_WARPGROUPS};
+}
+
+template<int D, bool is_causal, int CONSUMER_WARPGROUPS>
+__device__ static inline int get_kv_iters(const fwd_globals<D> &g, const int seq_idx) {
+    using K = fwd_attend_ker_tile_dims<D>;
+    if constexpr (is_causal) {
+        return ((seq_idx * K::qo_height) - 1 + (CONSUMER_WARPGROUPS * K::qo_height)) / K::kv_height;
+    }
+    else {
+        return (g.N + K::kv_height - 1) / (K::kv_height) - 1;
+    }
+}
+
 template<int D, bool is_causal, int CONSUMER_WARPGROUPS, int PRODUCER_WARPGROUPS>
 __global__  __launch_bounds__(((CONSUMER_WARPGROUPS+PRODUCER_WARPGROUPS)*kittens::WARPGROUP_WARPS)*kittens::WARP_THREADS, 1)
 void fwd_attend_ker(const __grid_constant__ fwd_globals<D> g) {
@@ -117,78 +221,68 @@ void fwd_attend_ker(const __grid_constant__ fwd_globals<D> g) {
         o_tile o;
     };
 
+    static_assert(sizeof(TileUnion) * CONSUMER_WARPGROUPS + (sizeof(k_tile) + sizeof(v_tile)) * K::stages + 1024 <= kittens::MAX_SHARED_MEMORY,
+                  "Shared memory tiles do not fit, reduce the number of stages");
+
     TileUnion (&q_o_smem)[CONSUMER_WARPGROUPS] = al.allocate<TileUnion, CONSUMER_WARPGROUPS>();
     k_tile    (&k_smem)[K::stages]           = al.allocate<k_tile, K::stages          >();
     v_tile    (&v_smem)[K::stages]           = al.allocate<v_tile, K::stages          >();
     // l_col_vec (&l_smem)[CONSUMER_WARPGROUPS] = al.allocate<l_col_vec, CONSUMER_WARPGROUPS>();
 
-    int kv_blocks   = (g.N + K::kv_height - 1) / (K::kv_height);
-    int kv_head_idx = blockIdx.y / g.hr;
-    int seq_idx     = blockIdx.x * CONSUMER_WARPGROUPS;
-
-    __shared__ kittens::semaphore qsmem_semaphore, k_smem_arrived[K::stages], v_smem_arrived[K::stages], compute_done[K::stages], qk_done[K::stages];
+    __shared__ kittens::semaphore qsmem_semaphore, o_stored, k_smem_arrived[K::stages], v_smem_arrived[K::stages], compute_done[K::stages], qk_done[K::stages];
     if (threadIdx.x == 0) {
         init_semaphore(qsmem_semaphore, 0, 1);
+        init_semaphore(o_stored, CONSUMER_WARPGROUPS, 0);
         for(int j = 0; j < K::stages; j++) {
             init_semaphore(k_smem_arrived[j], 0, 1);
             init_semaphore(v_smem_arrived[j], 0, 1);
-            if constexpr (D >= 128) {
-                init_semaphore(qk_done[j], CONSUMER_WARPGROUPS, 0);
-            }
+            init_semaphore(qk_done[j], CONSUMER_WARPGROUPS, 0);
             init_semaphore(compute_done[j], CONSUMER_WARPGROUPS, 0);
         }
-
-        tma::expect_bytes(qsmem_semaphore, sizeof(q_tile) * CONSUMER_WARPGROUPS);
-
-        for (int wg = 0; wg < CONSUMER_WARPGROUPS; wg++) {
-            coord<q_tile> q_tile_idx = {blockIdx.z, blockIdx.y, (seq_idx) + wg, 0};
-            tma::load_async(q_o_smem[wg].q, g.q, q_tile_idx, qsmem_semaphore);
-        }
-
-        for (int j = 0; j < K::stages - 1; j++) {
-            coord<k_tile> kv_tile_idx = {blockIdx.z, kv_head_idx, j, 0};
-            tma::expect_bytes(k_smem_arrived[j], sizeof(k_tile));
-            tma::load_async(k_smem[j], g.k, kv_tile_idx, k_smem_arrived[j]);
-            tma::expect_bytes(v_smem_arrived[j], sizeof(v_tile));
-            tma::load_async(v_smem[j], g.v, kv_tile_idx, v_smem_arrived[j]);
-        }
     }
     __syncthreads();
 
-    int pipe_idx = K::stages - 1;
-
     if(warpgroupid == NUM_WARPGROUPS-1) {
         // warpgroup::decrease_registers<32>();
         warpgroup::producer_registers();
 
-        int kv_iters;
-        if constexpr (is_causal) {
-            kv_iters = (seq_idx * K::qo_height) - 1 + (CONSUMER_WARPGROUPS * K::qo_height);
-            kv_iters = ((kv_iters / K::kv_height) == 0) ? (0) : ((kv_iters / K::kv_height) - 1);
-        }
-        else { kv_iters = kv_blocks-2; }
-
         if(warpid == NUM_WORKERS-4) {
-            for (auto kv_idx = pipe_idx - 1; kv_idx <= kv_iters; kv_idx++) {
-                coord<k_tile> kv_tile_idx = {blockIdx.z, kv_head_idx, kv_idx+1, 0};
-                if constexpr (D >= 128) {
-                    if (kv_idx >= pipe_idx) {
-                        wait(qk_done[(kv_idx-pipe_idx)%K::stages], ((kv_idx-(pipe_idx))/K::stages)%2);
+            // K/V tiles share one ring across all the tasks of this CTA
+            int load_idx = 0;
+            int task_iter = 0;
+            for (int task_id = blockIdx.x; task_id < g.num_tasks; task_id += gridDim.x, task_iter++) {
+                const fwd_task task = get_fwd_task<D, is_causal, CONSUMER_WARPGROUPS>(g, task_id);
+                const int kv_head_idx = task.head_idx / g.hr;
+                const int kv_iters = get_kv_iters<D, is_causal, CONSUMER_WARPGROUPS>(g, task.seq_idx);
+
+                for (auto kv_idx = 0; kv_idx <= kv_iters; kv_idx++, load_idx++) {
+                    const int stage = load_idx % K::stages;
+                    const int phase = (load_idx / K::stages - 1) % 2;
+                    coord<k_tile> kv_tile_idx = {task.batch_idx, kv_head_idx, kv_idx, 0};
+                    // K is free as soon as QK^T has read it, V only once P@V is done
+                    if (load_idx >= K::stages) {
+                        wait(qk_done[stage], phase);
                     }
-                } else {
-                    if (kv_idx >= pipe_idx) {
-                        wait(compute_done[(kv_idx-pipe_idx)%K::stages], ((kv_idx-(pipe_idx))/K::stages)%2);
+                    tma::expect_bytes(k_smem_arrived[stage], sizeof(k_tile));
+                    tma::load_async(k_smem[stage], g.k, kv_tile_idx, k_smem_arrived[stage]);
+                    if (load_idx >= K::stages) {
+                        wait(compute_done[stage], phase);
                     }
-                }
-                tma::expect_bytes(k_smem_arrived[(kv_idx+1)%K::stages], sizeof(k_tile));
-                tma::load_async(k_smem[(kv_idx+1)%K::stages], g.k, kv_tile_idx, k_smem_arrived[(kv_idx+1)%K::stages]);
-                if constexpr (D >= 128) {
-                    if (kv_idx >= pipe_idx) {
-                        wait(compute_done[(kv_idx-pipe_idx)%K::stages], ((kv_idx-(pipe_idx))/K::stages)%2);
+                    tma::expect_bytes(v_smem_arrived[stage], sizeof(v_tile));
+                    tma::load_async(v_smem[stage], g.v, kv_tile_idx, v_smem_arrived[stage]);
+
+                    if (kv_idx == 0) {
+                        // Q shares its shared memory with the O tiles of the previous task
+                        if (task_iter > 0) {
+                            wait(o_stored, (task_iter - 1) % 2);
+                        }
+                        tma::expect_bytes(qsmem_semaphore, sizeof(q_tile) * CONSUMER_WARPGROUPS);
+                        for (int wg = 0; wg < CONSUMER_WARPGROUPS; wg++) {
+                            coord<q_tile> q_tile_idx = {task.batch_idx, task.head_idx, (task.seq_idx) + wg, 0};
+                            tma::load_async(q_o_smem[wg].q, g.q, q_tile_idx, qsmem_semaphore);
+                        }
                     }
                 }
-                tma::expect_bytes(v_smem_arrived[(kv_idx+1)%K::stages], sizeof(v_tile));
-                tma::load_async(v_smem[(kv_idx+1)%K::stages], g.v, kv_tile_idx, v_smem_arrived[(kv_idx+1)%K::stages]);
             }
         }
     }
@@ -198,161 +292,218 @@ void fwd_attend_ker(const __grid_constant__ fwd_globals<D> g) {
 
         rt_fl<16, K::tile_width> o_reg;
 
-#if defined(TK_ATTN_IS_FP8)
-        col_vec<rt_fl<16, K::kv_height>> max_vec, norm_vec, max_vec_last;
+        col_vec<rt_fl<16, K::kv_height>> max_vec, norm_vec, correction;
 
-        float scale_q = g.scale_q[blockIdx.z*gridDim.y + blockIdx.y];
-        float scale_k = g.scale_k[blockIdx.z*gridDim.y + blockIdx.y];
+        rt_fl<16, K::kv_height>  att_block;
+        rt<DType, 16, K::kv_height>  att_block_mma;
 
-        float scale = scale_q * scale_k;
-        if constexpr (D == 64)       { scale *= 1.44269504089f*0.125f; }
-        else if constexpr (D == 128) { scale *= 1.44269504089f*0.08838834764f; }
-        else                         { scale *= 1.44269504089f*0.0625f; }
-#else
-        col_vec<rt_fl<16, K::kv_height>> max_vec, norm_vec, max_vec_last_scaled;
-#endif
+        // an in-flight P@V keeps o_reg, att_block and att_block_mma live through the softmax, which only fits
+        // in the 240 registers of the 2-consumer configs; with 3 consumers (160 registers) it would spill
+        constexpr bool overlap_pv = CONSUMER_WARPGROUPS < 3;
 
-        neg_infty(max_vec);
-        zero(norm_vec);
-        zero(o_reg);
+        int load_idx = 0;
+        int task_iter = 0;
+        for (int task_id = blockIdx.x; task_id < g.num_tasks; task_id += gridDim.x, task_iter++) {
+            const fwd_task task = get_fwd_task<D, is_causal, CONSUMER_WARPGROUPS>(g, task_id);
+            const int seq_idx = task.seq_idx;
+            const int kv_iters = get_kv_iters<D, is_causal, CONSUMER_WARPGROUPS>(g, seq_idx);
 
-        int kv_iters;
-        if constexpr (is_causal) {
-            kv_iters = (seq_idx * K::qo_height) - 1 + (CONSUMER_WARPGROUPS * K::qo_height);
-            kv_iters = (kv_iters / K::kv_height);
-        }
-        else { kv_iters = kv_blocks - 1; }
+            float scale;
+            if constexpr (D == 64)       { scale = 1.44269504089f*0.125f; }
+            else if constexpr (D == 128) { scale = 1.44269504089f*0.08838834764f; }
+            else                         { scale = 1.44269504089f*0.0625f; }
+#if defined(TK_ATTN_IS_FP8)
+            scale *= g.scale_q[task.batch_idx*g.qo_heads + task.head_idx];
+            scale *= g.scale_k[task.batch_idx*(g.qo_heads/g.hr) + task.head_idx/g.hr];
+#endif
 
-        wait(qsmem_semaphore, 0);
+            neg_infty(max_vec);
+            zero(norm_vec);
+            zero(o_reg);
 
-        for (auto kv_idx = 0; kv_idx <= kv_iters; kv_idx++) {
-            rt_fl<16, K::kv_height>  att_block;
-            rt<DType, 16, K::kv_height>  att_block_mma;
+            wait(qsmem_semaphore, task_iter % 2);
 
-            wait(k_smem_arrived[(kv_idx)%K::stages], (kv_idx/K::stages)%2);
-            warpgroup::mm_ABt(att_block, q_o_smem[warpgroupid].q, k_smem[(kv_idx)%K::stages]);
+            wait(k_smem_arrived[(load_idx)%K::stages], (load_idx/K::stages)%2);
+            warpgroup::mm_ABt(att_block, q_o_smem[warpgroupid].q, k_smem[(load_idx)%K::stages]);
 
-#if defined(TK_ATTN_IS_FP8)
-            copy(max_vec_last, max_vec);
-#else
-            if constexpr (D == 64)       { mul(max_vec_last_scaled, max_vec, 1.44269504089f*0.125f); }
-            else if constexpr (D == 128) { mul(max_vec_last_scaled, max_vec, 1.44269504089f*0.08838834764f); }
-            else                         { mul(max_vec_last_scaled, max_vec, 1.44269504089f*0.0625f); }
-#endif
+            for (auto kv_idx = 0; kv_idx <= kv_iters; kv_idx++, load_idx++) {
+                // P@V of the previous block stays in flight while the softmax of this block runs
+                if (overlap_pv && kv_idx > 0) {
+                    wait(v_smem_arrived[(load_idx-1)%K::stages], ((load_idx-1)/K::stages)%2);
+                    warpgroup::mma_AB(o_reg, att_block_mma, v_smem[(load_idx-1)%K::stages]);
+                    warpgroup::mma_async_wait<1>();
+                }
+                else {
+                    warpgroup::mma_async_wait();
+                }
+                if(warpgroup::laneid() == 0) arrive(qk_done[(load_idx)%K::stages], 1);
 
-            warpgroup::mma_async_wait();
-            if constexpr (D >= 128) {
-                if(warpgroup::laneid() == 0) arrive(qk_done[(kv_idx)%K::stages], 1);
-            }
+                const bool mask = is_causal ? kv_idx >= kv_iters-1 : (kv_idx == kv_iters && g.N % K::kv_height != 0);
+                online_softmax<is_causal>(att_block, max_vec, norm_vec, correction, scale, mask,
+                                          (seq_idx * K::qo_height) + (warpid * kittens::TILE_ROW_DIM<float>), kv_idx * K::kv_height, g.N);
 
-#if defined(TK_ATTN_IS_FP8)
-            mul(att_block, att_block, scale);
-#endif
+                if constexpr (overlap_pv) {
+                    warpgroup::mma_async_wait();
+                    if (kv_idx > 0) {
+                        if(warpgroup::laneid() == 0) arrive(compute_done[(load_idx-1)%K::stages], 1);
+                    }
+                }
 
-            if constexpr (is_causal) {
-                if (kv_idx == kv_iters-1 || kv_idx == kv_iters) {
-                    const int q_blk = (seq_idx * (K::qo_height/kittens::TILE_ROW_DIM<QKDType>)) + warpid;
-                        int k_blk = (kv_idx * (K::kv_height/kittens::TILE_ROW_DIM<QKDType>));
+                mul_row(o_reg, o_reg, correction);
+                copy(att_block_mma, att_block);
 
-                    #pragma unroll
-                    for (auto j = 0; j < (K::kv_height/kittens::TILE_ROW_DIM<QKDType>); j++) {
-                        auto k_idx = k_blk + j;
-                        auto &attn_subtile = reinterpret_cast<rt_fl<16, 16>&>(att_block.tiles[0][j]);
+                if constexpr (!overlap_pv) {
+                    wait(v_smem_arrived[(load_idx)%K::stages], (load_idx/K::stages)%2);
+                    warpgroup::mma_AB(o_reg, att_block_mma, v_smem[(load_idx)%K::stages]);
+                    warpgroup::mma_async_wait();
+                    if(warpgroup::laneid() == 0) arrive(compute_done[(load_idx)%K::stages], 1);
+                }
 
-                        if      (k_idx >  q_blk) { neg_infty  (attn_subtile); }
-                        else if (k_idx == q_blk) { make_causal(attn_subtile, attn_subtile, kittens::base_types::constants<float>::neg_infty()); }
-                        __syncwarp();
-                    }
+                if (kv_idx < kv_iters) {
+                    wait(k_smem_arrived[(load_idx+1)%K::stages], ((load_idx+1)/K::stages)%2);
+                    warpgroup::mm_ABt(att_block, q_o_smem[warpgroupid].q, k_smem[(load_idx+1)%K::stages]);
                 }
             }
-            else {
-                if (kv_idx == kv_iters && g.N % K::kv_height != 0) {
-                    right_fill(att_block, att_block, g.N % K::kv_height, kittens::base_types::constants<float>::neg_infty());
-                }
+
+            if constexpr (overlap_pv) {
+                wait(v_smem_arrived[(load_idx-1)%K::stages], ((load_idx-1)/K::stages)%2);
+                warpgroup::mma_AB(o_reg, att_block_mma, v_smem[(load_idx-1)%K::stages]);
+                warpgroup::mma_async_wait();
+                if(warpgroup::laneid() == 0) arrive(compute_done[(load_idx-1)%K::stages], 1);
             }
 
-            row_max(max_vec, att_block, max_vec);
+            reciprocal(norm_vec, norm_vec);
+            mul_row(o_reg, o_reg, norm_vec);
+            warpgroup::store(q_o_smem[warpgroupid].o, o_reg);
+            warpgroup::sync(warpgroupid+4);
 
-#if defined(TK_ATTN_IS_FP8)
-            sub_row(att_block, att_block, max_vec);
-            exp2(att_block, att_block);
-            // unary_map<base_ops::fast_exp2>(att_block, att_block);
-            sub(max_vec_last, max_vec_last, max_vec);
-            exp2(max_vec_last,       max_vec_last);
-            // unary_op<base_ops::fast_exp2>(max_vec_last, max_vec_last);
-            mul(norm_vec,            norm_vec,     max_vec_last);
-            row_sum(norm_vec,  att_block, norm_vec);
-            // add(att_block, att_block, 0.f);
-            copy(att_block_mma, att_block);
-            mul_row(o_reg, o_reg, max_vec_last);
-#else
-            col_vec<rt_fl<16, K::kv_height>> max_vec_scaled;
-            if constexpr (D == 64) {
-                mul(att_block, att_block,    1.44269504089f*0.125f);
-                mul(max_vec_scaled, max_vec, 1.44269504089f*0.125f);
-            }
-            else if constexpr (D == 128) {
-                mul(att_block, att_block,    1.44269504089f*0.08838834764f);
-                mul(max_vec_scaled, max_vec, 1.44269504089f*0.08838834764f);
-            }
-            else {
-                mul(att_block, att_block,    1.44269504089f*0.0625f);
-                mul(max_vec_scaled, max_vec, 1.44269504089f*0.0625f);
+            if (warpid % 4 == 0) {
+                coord<o_tile> o_tile_idx = {task.batch_idx, task.head_idx, (seq_idx) + warpgroupid, 0};
+                tma::store_async(g.o, q_o_smem[warpgroupid].o, o_tile_idx);
+                tma::store_async_read_wait();
+                if(kittens::laneid() == 0) arrive(o_stored, 1);
             }
 
-            sub_row(att_block, att_block, max_vec_scaled);
-            exp2(att_block, att_block);
-            // unary_map<base_ops::fast_exp2>(att_block, att_block);
-            sub(max_vec_last_scaled, max_vec_last_scaled, max_vec_scaled);
-            exp2(max_vec_last_scaled,       max_vec_last_scaled);
-            // unary_op<base_ops::fast_exp2>(max_vec_last_scaled, max_vec_last_scaled);
-            mul(norm_vec,            norm_vec,     max_vec_last_scaled);
-            row_sum(norm_vec,  att_block, norm_vec);
-            // add(att_block, att_block, 0.f);
-            copy(att_block_mma, att_block);
-            mul_row(o_reg, o_reg, max_vec_last_scaled);
-#endif
+            // mul(max_vec_scaled,   max_vec_scaled, 0.69314718056f);
+            // log(norm_vec, norm_vec);
+            // add(norm_vec, norm_vec, max_vec_scaled);
 
-            wait(v_smem_arrived[(kv_idx)%K::stages], (kv_idx/K::stages)%2);
+            // if constexpr (D == 64) { mul(norm_vec, norm_vec, -8.0f); }
+            // else                   { mul(norm_vec, norm_vec, -11.313708499f); }
 
-            warpgroup::mma_AB(o_reg, att_block_mma, v_smem[(kv_idx)%K::stages]);
-            warpgroup::mma_async_wait();
+            // warpgroup::store(l_smem[warpgroupid], norm_vec);
+            // warpgroup::sync(warpgroupid+4);
 
-            if(warpgroup::laneid() == 0) arrive(compute_done[(kv_idx)%K::stages], 1);
+            // if (warpid % 4 == 0) {
+            //     coord<l_col_vec> tile_idx = {task.batch_idx, task.head_idx, 0, (seq_idx) + warpgroupid};
+            //     tma::store_async(g.l, l_smem[warpgroupid], tile_idx);
+            // }
         }
+        tma::store_async_wait();
+    }
+}
 
-        div_row(o_reg, o_reg, norm_vec);
-        warpgroup::store(q_o_smem[warpgroupid].o, o_reg);
-        warpgroup::sync(warpgroupid+4);
+#include "pyutils/torch_helpers.cuh"
+#include <ATen/cuda/CUDAContext.h>
+#include <iostream>
+#include <mutex>
 
-        if (warpid % 4 == 0) {
-            coord<o_tile> o_tile_idx = {blockIdx.z, blockIdx.y, (seq_idx) + warpgroupid, 0};
-            tma::store_async(g.o, q_o_smem[warpgroupid].o, o_tile_idx);
-        }
+struct fwd_launch_args {
+    QKDType *d_q;
+    QKDType *d_k;
+    DType *d_v;
+    DType *d_o;
+#if TK_ATTN_IS_FP8
+    float *d_scale_q;
+    float *d_scale_k;
+#endif
+    int batch;
+    int qo_heads;
+    int kv_heads;
+    int seq_len_q;
+    int seq_len_kv;
+};
 
-        // mul(max_vec_scaled,   max_vec_scaled, 0.69314718056f);
-        // log(norm_vec, norm_vec);
-        // add(norm_vec, norm_vec, max_vec_scaled);
+template<int D, bool is_causal, int CONSUMER_WARPGROUPS, int PRODUCER_WARPGROUPS>
+void launch_fwd(const fwd_launch_args &args, cudaStream_t stream)
+{
+    auto [d_q, d_k, d_v, d_o,
+#if TK_ATTN_IS_FP8
+          d_scale_q, d_scale_k,
+#endif
+          batch, qo_heads, kv_heads, seq_len_q, seq_len_kv] = args;
+
+    constexpr int NUM_WARPGROUPS      = (CONSUMER_WARPGROUPS+PRODUCER_WARPGROUPS);
+    constexpr int NUM_WORKERS         = (NUM_WARPGROUPS*kittens::WARPGROUP_WARPS);
 
-        // if constexpr (D == 64) { mul(norm_vec, norm_vec, -8.0f); }
-        // else                   { mul(norm_vec, norm_vec, -11.313708499f); }
+    using globals = fwd_globals<D>;
 
-        // warpgroup::store(l_smem[warpgroupid], norm_vec);
-        // warpgroup::sync(warpgroupid+4);
+    typename globals::q_gl qg_arg{d_q, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
+    typename globals::k_gl kg_arg{d_k, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
+    typename globals::v_gl vg_arg{d_v, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
+    // typename globals::l_gl lg_arg{d_l, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), nullptr, static_cast<unsigned int>(l_vec_stride_h)};
+    typename globals::o_gl og_arg{d_o, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
 
-        // if (warpid % 4 == 0) {
-        //     coord<l_col_vec> tile_idx = {blockIdx.z, blockIdx.y, 0, (seq_idx) + warpgroupid};
-        //     tma::store_async(g.l, l_smem[warpgroupid], tile_idx);
-        // }
-        tma::store_async_wait();
-    }
+    constexpr int block_size_m = CONSUMER_WARPGROUPS*fwd_attend_ker_tile_dims<D>::qo_height;
+    int num_m_blocks = (seq_len_q + block_size_m - 1) / block_size_m;
+    int num_tasks    = num_m_blocks * qo_heads * batch;
+
+#if TK_ATTN_IS_FP8
+    globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, d_scale_q, d_scale_k, seq_len_kv, qo_heads / kv_heads, qo_heads, num_m_blocks, num_tasks};
+#else
+    globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, seq_len_kv, qo_heads / kv_heads, qo_heads, num_m_blocks, num_tasks};
+#endif
+
+    static constexpr int mem_size = kittens::MAX_SHARED_MEMORY;
+    // auto threads  = NUM_WORKERS * kittens::WARP_THREADS;
+
+    int num_sms = at::cuda::getCurrentDeviceProperties()->multiProcessorCount;
+    dim3 grid(std::min(num_sms, num_tasks));
+
+    // function attributes live in the device context, so set them once per device
+    static std::once_flag attr_flags[C10_COMPILE_TIME_MAX_GPUS];
+    std::call_once(attr_flags[c10::cuda::current_device()], [] {
+        int max_shared_memory;
+        CHECK_CUDA_ERROR(cudaDeviceGetAttribute(&max_shared_memory, cudaDevAttrMaxSharedMemoryPerBlockOptin, c10::cuda::current_device()));
+        TORCH_CHECK(mem_size <= max_shared_memory, "fwd_attend_ker<", D, "> needs ", mem_size,
+                    " bytes of shared memory but the device only allows ", max_shared_memory, " per block");
+        CHECK_CUDA_ERROR(cudaFuncSetAttribute(
+            fwd_attend_ker<D, is_causal, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
+            cudaFuncAttributeMaxDynamicSharedMemorySize,
+            mem_size
+        ));
+        CHECK_CUDA_ERROR(cudaFuncSetAttribute(
+            fwd_attend_ker<D, is_causal, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
+            cudaFuncAttributePreferredSharedMemoryCarveout,
+            cudaSharedmemCarveoutMaxShared
+        ));
+#if defined(TK_ATTN_KERNEL_STATS)
+        cudaFuncAttributes attr;
+        CHECK_CUDA_ERROR(cudaFuncGetAttributes(&attr, fwd_attend_ker<D, is_causal, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>));
+        if (attr.localSizeBytes > 0) {
+            TORCH_WARN("fwd_attend_ker<", D, ", ", is_causal, "> uses ", attr.localSizeBytes,
+                       " bytes of local memory per thread with ", attr.numRegs, " registers, registers are spilling");
+        }
+#endif
+    });
+
+    fwd_attend_ker<D, is_causal, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
 }
+"""
 
-#include "pyutils/torch_helpers.cuh"
-#include <ATen/cuda/CUDAContext.h>
-#include <iostream>
+TK_ATTENTION_FWD_CONFIGS = (
+    # (head_dim, consumer warpgroups, producer warpgroups)
+    (64, 3, 1),
+    (128, 3, 1),
+    (256, 2, 1),
+)
+
+TK_ATTENTION_HOST_SOURCE = """
+#include <torch/types.h>
 
-std::vector<torch::Tensor>
+#include "tk_attention.cuh"
+
+torch::Tensor
 #if TK_ATTN_IS_FP8
 attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::Tensor &v, const torch::Tensor &scale_q, const torch::Tensor &scale_k, bool causal)
 #else
@@ -395,6 +546,7 @@ attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::T
     TORCH_CHECK(k.size(3) == head_dim, "K head dimension - idx 3 - must match for all non-vector inputs");
     TORCH_CHECK(v.size(3) == head_dim, "V head dimension - idx 3 - must match for all non-vector inputs");
 
+    TORCH_CHECK(kv_heads > 0, "KV heads must be positive");
     TORCH_CHECK(qo_heads >= kv_heads, "QO heads must be greater than or equal to KV heads");
     TORCH_CHECK(qo_heads % kv_heads == 0, "QO heads must be divisible by KV heads");
     TORCH_CHECK(q.size(1) == qo_heads, "QO head dimension - idx 1 - must match for all inputs");
@@ -414,14 +566,19 @@ attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::T
     TORCH_CHECK(scale_k.size(1) == kv_heads, "K scale head dimension - idx 1 - must match for all inputs");
 #endif
 
+    TORCH_CHECK(TK_ATTN_IS_SUPPORTED_HEAD_DIM, "Unsupported head dimension: ", head_dim);
+
+    if (batch == 0 || seq_len_q == 0 || seq_len_kv == 0) {
+        // nothing to launch, attending to no keys sums over nothing
+        return torch::zeros({batch, qo_heads, seq_len_q, head_dim}, v.options());
+    }
+
     torch::DeviceGuard device_guard(q.device());
 
     torch:: Tensor q_ = q.contiguous();
     torch:: Tensor k_ = k.contiguous();
     torch:: Tensor v_ = v.contiguous();
 
-    auto hr = qo_heads / kv_heads;
-
     void* q_ptr = q_.data_ptr();
     void* k_ptr = k_.data_ptr();
     void* v_ptr = v_.data_ptr();
@@ -464,190 +621,68 @@ attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::T
 
     auto stream = at::cuda::getCurrentCUDAStream().stream();
 
-    if (head_dim == 64) {
-        constexpr int CONSUMER_WARPGROUPS = (3);
-        constexpr int PRODUCER_WARPGROUPS = (1);
-        constexpr int NUM_WARPGROUPS      = (CONSUMER_WARPGROUPS+PRODUCER_WARPGROUPS);
-        constexpr int NUM_WORKERS         = (NUM_WARPGROUPS*kittens::WARPGROUP_WARPS);
-
-        using q_tile    =         st<QKDType, fwd_attend_ker_tile_dims<64>::qo_height, fwd_attend_ker_tile_dims<64>::tile_width>;
-        using k_tile    =         st<QKDType, fwd_attend_ker_tile_dims<64>::kv_height, fwd_attend_ker_tile_dims<64>::tile_width>;
-        using v_tile    =         st<DType, fwd_attend_ker_tile_dims<64>::kv_height, fwd_attend_ker_tile_dims<64>::tile_width>;
-        // using l_col_vec = col_vec<st_fl<fwd_attend_ker_tile_dims<64>::qo_height, fwd_attend_ker_tile_dims<64>::tile_width>>;
-        using o_tile    =         st<DType, fwd_attend_ker_tile_dims<64>::qo_height, fwd_attend_ker_tile_dims<64>::tile_width>;
-
-        using q_global = gl<QKDType,  -1, -1, -1, 64, q_tile>;
-        using k_global = gl<QKDType,  -1, -1, -1, 64, k_tile>;
-        using v_global = gl<DType,  -1, -1, -1, 64, v_tile>;
-        // using l_global = gl<float, -1, -1, 1, -1, l_col_vec>;
-        using o_global = gl<DType,  -1, -1, -1, 64, o_tile>;
-
-        using globals      = fwd_globals<64>;
-
-        q_global qg_arg{d_q, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
-        k_global kg_arg{d_k, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
-        v_global vg_arg{d_v, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
-        // l_global lg_arg{d_l, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), nullptr,  static_cast<unsigned int>(l_vec_stride_h)};
-        o_global og_arg{d_o, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
-
+    fwd_launch_args args{d_q, d_k, d_v, d_o,
 #if TK_ATTN_IS_FP8
-        globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, d_scale_q, d_scale_k, static_cast<int>(seq_len_kv), static_cast<int>(hr)};
-#else
-        globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, static_cast<int>(seq_len_kv), static_cast<int>(hr)};
+                         d_scale_q, d_scale_k,
 #endif
+                         static_cast<int>(batch), static_cast<int>(qo_heads), static_cast<int>(kv_heads),
+                         static_cast<int>(seq_len_q), static_cast<int>(seq_len_kv)};
 
-        auto mem_size = kittens::MAX_SHARED_MEMORY;
-        // auto threads  = NUM_WORKERS * kittens::WARP_THREADS;
-
-        constexpr int block_size_m = CONSUMER_WARPGROUPS*fwd_attend_ker_tile_dims<64>::qo_height;
-        int num_m_blocks = (seq_len_q + block_size_m - 1) / block_size_m;
-        dim3 grid(num_m_blocks, qo_heads, batch);
-
-        if (is_causal) {
-            CHECK_CUDA_ERROR(cudaFuncSetAttribute(
-                fwd_attend_ker<64, true, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
-                cudaFuncAttributeMaxDynamicSharedMemorySize,
-                mem_size
-            ));
-
-            fwd_attend_ker<64, true, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
-        }
-        else {
-            CHECK_CUDA_ERROR(cudaFuncSetAttribute(
-                fwd_attend_ker<64, false, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
-                cudaFuncAttributeMaxDynamicSharedMemorySize,
-                mem_size
-            ));
-
-            fwd_attend_ker<64, false, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
-        }
-    }
-
-    if (head_dim == 128) {
-        constexpr int CONSUMER_WARPGROUPS = (3);
-        constexpr int PRODUCER_WARPGROUPS = (1);
-        constexpr int NUM_WARPGROUPS      = (CONSUMER_WARPGROUPS+PRODUCER_WARPGROUPS);
-        constexpr int NUM_WORKERS         = (NUM_WARPGROUPS*kittens::WARPGROUP_WARPS);
-
-        using q_tile    =         st<QKDType, fwd_attend_ker_tile_dims<128>::qo_height, fwd_attend_ker_tile_dims<128>::tile_width>;
-        using k_tile    =         st<QKDType, fwd_attend_ker_tile_dims<128>::kv_height, fwd_attend_ker_tile_dims<128>::tile_width>;
-        using v_tile    =         st<DType, fwd_attend_ker_tile_dims<128>::kv_height, fwd_attend_ker_tile_dims<128>::tile_width>;
-        // using l_col_vec = col_vec<st_fl<fwd_attend_ker_tile_dims<128>::qo_height, fwd_attend_ker_tile_dims<128>::tile_width>>;
-        using o_tile    =         st<DType, fwd_attend_ker_tile_dims<128>::qo_height, fwd_attend_ker_tile_dims<128>::tile_width>;
-
-        using q_global = gl<QKDType,  -1, -1, -1, 128, q_tile>;
-        using k_global = gl<QKDType,  -1, -1, -1, 128, k_tile>;
-        using v_global = gl<DType,  -1, -1, -1, 128, v_tile>;
-        // using l_global = gl<float, -1, -1, 1, -1, l_col_vec>;
-        using o_global = gl<DType,  -1, -1, -1, 128, o_tile>;
-
-        using globals      = fwd_globals<128>;
-
-        q_global qg_arg{d_q, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
-        k_global kg_arg{d_k, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
-        v_global vg_arg{d_v, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
-        // l_global lg_arg{d_l, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), nullptr,   static_cast<unsigned int>(l_vec_stride_h)};
-        o_global og_arg{d_o, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
-
-#if TK_ATTN_IS_FP8
-        globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, d_scale_q, d_scale_k, static_cast<int>(seq_len_kv), static_cast<int>(hr)};
-#else
-        globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, static_cast<int>(seq_len_kv), static_cast<int>(hr)};
-#endif
-
-        auto mem_size = kittens::MAX_SHARED_MEMORY;
-        // auto threads  = NUM_WORKERS * kittens::WARP_THREADS;
-
-        constexpr int block_size_m = CONSUMER_WARPGROUPS*fwd_attend_ker_tile_dims<128>::qo_height;
-        int num_m_blocks = (seq_len_q + block_size_m - 1) / block_size_m;
-        dim3 grid(num_m_blocks, qo_heads, batch);
-
-        if (is_causal) {
-            CHECK_CUDA_ERROR(cudaFuncSetAttribute(
-                fwd_attend_ker<128, true, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
-                cudaFuncAttributeMaxDynamicSharedMemorySize,
-                mem_size
-            ));
-
-            fwd_attend_ker<128, true, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
-        }
-        else {
-            CHECK_CUDA_ERROR(cudaFuncSetAttribute(
-                fwd_attend_ker<128, false, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
-                cudaFuncAttributeMaxDynamicSharedMemorySize,
-                mem_size
-            ));
-
-            fwd_attend_ker<128, false, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
-        }
-    }
-
-    if (head_dim == 256) {
-        constexpr int CONSUMER_WARPGROUPS = (2);
-        constexpr int PRODUCER_WARPGROUPS = (1);
-        constexpr int NUM_WARPGROUPS      = (CONSUMER_WARPGROUPS+PRODUCER_WARPGROUPS);
-        constexpr int NUM_WORKERS         = (NUM_WARPGROUPS*kittens::WARPGROUP_WARPS);
-
-        using q_tile    =         st<QKDType, fwd_attend_ker_tile_dims<256>::qo_height, fwd_attend_ker_tile_dims<256>::tile_width>;
-        using k_tile    =         st<QKDType, fwd_attend_ker_tile_dims<256>::kv_height, fwd_attend_ker_tile_dims<256>::tile_width>;
-        using v_tile    =         st<DType, fwd_attend_ker_tile_dims<256>::kv_height, fwd_attend_ker_tile_dims<256>::tile_width>;
-        // using l_col_vec = col_vec<st_fl<fwd_attend_ker_tile_dims<256>::qo_height, fwd_attend_ker_tile_dims<256>::tile_width>>;
-        using o_tile    =         st<DType, fwd_attend_ker_tile_dims<256>::qo_height, fwd_attend_ker_tile_dims<256>::tile_width>;
-
-        using q_global = gl<QKDType,  -1, -1, -1, 256, q_tile>;
-        using k_global = gl<QKDType,  -1, -1, -1, 256, k_tile>;
-        using v_global = gl<DType,  -1, -1, -1, 256, v_tile>;
-        // using l_global = gl<float, -1, -1, 1, -1, l_col_vec>;
-        using o_global = gl<DType,  -1, -1, -1, 256, o_tile>;
-
-        using globals      = fwd_globals<256>;
-
-        q_global qg_arg{d_q, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
-        k_global kg_arg{d_k, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
-        v_global vg_arg{d_v, static_cast<unsigned int>(batch), static_cast<unsigned int>(kv_heads), static_cast<unsigned int>(seq_len_kv), nullptr};
-        // l_global lg_arg{d_l, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), nullptr,   static_cast<unsigned int>(l_vec_stride_h)};
-        o_global og_arg{d_o, static_cast<unsigned int>(batch), static_cast<unsigned int>(qo_heads), static_cast<unsigned int>(seq_len_q), nullptr};
-
-#if TK_ATTN_IS_FP8
-        globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, d_scale_q, d_scale_k, static_cast<int>(seq_len_kv), static_cast<int>(hr)};
-#else
-        globals g{qg_arg, kg_arg, vg_arg/* , lg_arg */, og_arg, static_cast<int>(seq_len_kv), static_cast<int>(hr)};
-#endif
-
-        auto mem_size = kittens::MAX_SHARED_MEMORY;
-        // auto threads  = NUM_WORKERS * kittens::WARP_THREADS;
-
-        constexpr int block_size_m = CONSUMER_WARPGROUPS*fwd_attend_ker_tile_dims<256>::qo_height;
-        int num_m_blocks = (seq_len_q + block_size_m - 1) / block_size_m;
-        dim3 grid(num_m_blocks, qo_heads, batch);
-
-        if (is_causal) {
-            CHECK_CUDA_ERROR(cudaFuncSetAttribute(
-                fwd_attend_ker<256, true, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
-                cudaFuncAttributeMaxDynamicSharedMemorySize,
-                mem_size
-            ));
-
-            fwd_attend_ker<256, true, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
-        }
-        else {
-            CHECK_CUDA_ERROR(cudaFuncSetAttribute(
-                fwd_attend_ker<256, false, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS>,
-                cudaFuncAttributeMaxDynamicSharedMemorySize,
-                mem_size
-            ));
-
-            fwd_attend_ker<256, false, CONSUMER_WARPGROUPS, PRODUCER_WARPGROUPS><<<grid, (32*NUM_WORKERS), mem_size, stream>>>(g);
-        }
+    switch (head_dim) {
+    TK_ATTN_LAUNCH_FWD_CASES
+    default:
+        TORCH_CHECK(false, "Unsupported head dimension: ", head_dim);
     }
 
     C10_CUDA_KERNEL_LAUNCH_CHECK();
 
-    return {o/* , l_vec */};
+    return o/* , l_vec */;
 }
 """
 
 
+def get_tk_attention_sources(is_fp8=False):
+    # every kernel instantiation gets its own translation unit so that ninja can compile them in parallel,
+    # the host code only sees extern declarations of them
+    sources = {"tk_attention.cuh": TK_ATTENTION_KERNEL_SOURCE}
+    extern_templates = []
+    launch_fwd_cases = []
+    for head_dim, consumer_warpgroups, producer_warpgroups in TK_ATTENTION_FWD_CONFIGS:
+        launch_fwd_cases.append(
+            f"""case {head_dim}:
+        if (is_causal) {{ launch_fwd<{head_dim}, true, {consumer_warpgroups}, {producer_warpgroups}>(args, stream); }}
+        else           {{ launch_fwd<{head_dim}, false, {consumer_warpgroups}, {producer_warpgroups}>(args, stream); }}
+        break;"""
+        )
+        for is_causal in (False, True):
+            launch_fwd = f"void launch_fwd<{head_dim}, {str(is_causal).lower()}, {consumer_warpgroups}, {producer_warpgroups}>(const fwd_launch_args &args, cudaStream_t stream);"
+            filename = f"tk_attention_fwd_{head_dim}_{'causal' if is_causal else 'non_causal'}.cu"
+            sources[filename] = f'#include "tk_attention.cuh"\n\ntemplate {launch_fwd}\n'
+            extern_templates.append(f"extern template {launch_fwd}")
+    sources["tk_attention.cu"] = TK_ATTENTION_HOST_SOURCE.replace(
+        '#include "tk_attention.cuh"\n', '#include "tk_attention.cuh"\n\n' + "\n".join(extern_templates) + "\n", 1
+    ).replace("TK_ATTN_LAUNCH_FWD_CASES", "\n    ".join(launch_fwd_cases), 1).replace(
+        "TK_ATTN_IS_SUPPORTED_HEAD_DIM",
+        " || ".join(f"head_dim == {head_dim}" for head_dim, _, _ in TK_ATTENTION_FWD_CONFIGS),
+        1,
+    )
+
+    declaration = (
+        "torch::Tensor attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::Tensor &v, const torch::Tensor &scale_q, const torch::Tensor &scale_k, bool causal);"
+        if is_fp8
+        else "torch::Tensor attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::Tensor &v, bool causal);"
+    )
+    sources["tk_attention_bindings.cpp"] = f"""#include <torch/extension.h>
+
+{declaration}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {{
+    m.def("attention_forward", &attention_forward, "attention_forward");
+}}
+"""
+    return sources
+
+
 @functools.cache
 def load_tk_attention_module(dtype, is_fp8=False):
     extra_cuda_cflags = [
@@ -662,10 +697,6 @@ def load_tk_attention_module(dtype, is_fp8=False):
         # "-U__CUDA_NO_BFLOAT162_CONVERSIONS__",
         "--expt-extended-lambda",
         "--expt-relaxed-constexpr",
-        "--use_fast_math",
-        # "--ptxas-options=-v",  # printing out number of registers
-        # "--ptxas-options=--verbose,--register-usage-level=10,--warn-on-local-memory-usage",  # printing out number of registers
-        "-lineinfo",
         "-O3",
         "-Xcudafe --diag_suppress=2361",
         "--threads=4",
@@ -682,27 +713,47 @@ def load_tk_attention_module(dtype, is_fp8=False):
     if is_fp8:
         extra_cuda_cflags.append("-DTK_ATTN_IS_FP8")
 
-    old_torch_cuda_arch_list = os.getenv("TORCH_CUDA_ARCH_LIST")
-    os.environ["TORCH_CUDA_ARCH_LIST"] = "9.0a"
-    try:
-        module = load_inline(
-            name=f"quantum_attn_tk_attention_dtype_{str(dtype).replace('torch.', '')}_is_fp8_{is_fp8}",
-            cpp_sources=[
-                "std::vector<torch::Tensor> attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::Tensor &v, const torch::Tensor &scale_q, const torch::Tensor &scale_k, bool causal);"
-                if is_fp8
-                else "std::vector<torch::Tensor> attention_forward(const torch::Tensor &q, const torch::Tensor &k, const torch::Tensor &v, bool causal);"
-            ],
-            cuda_sources=[TK_ATTENTION_SOURCE],
-            extra_cflags=["-std=c++20", "-O3", "-DNDEBUG"],
-            extra_cuda_cflags=extra_cuda_cflags,
-            extra_ldflags=["-lcuda", "-lcudart"],
-            extra_include_paths=[utils.get_tk_include_dir()],
-            functions=["attention_forward"],
-            verbose=True,
-        )
-    finally:
-        if old_torch_cuda_arch_list is None:
-            os.environ.pop("TORCH_CUDA_ARCH_LIST")
-        else:
-            os.environ["TORCH_CUDA_ARCH_LIST"] = old_torch_cuda_arch_list
-    return module
+    if config.tk.line_info:
+        extra_cuda_cflags.append("-lineinfo")
+
+    if config.tk.kernel_stats:
+        extra_cuda_cflags += [
+            "--ptxas-options=--verbose,--warn-on-local-memory-usage,--warn-on-spills",
+            "-DTK_ATTN_KERNEL_STATS",
+        ]
+
+    sources = get_tk_attention_sources(is_fp8)
+    extra_cflags = ["-std=c++20", "-O3", "-DNDEBUG"]
+    extra_ldflags = ["-lcuda", "-lcudart"]
+    # load() takes its arch flags from TORCH_CUDA_ARCH_LIST or the visible devices, never from extra_cuda_cflags
+    torch_cuda_arch_list = "9.0a"
+
+    # a previous process may already have built this exact configuration, import it without going through ninja
+    build_hash = utils.get_build_hash(
+        sorted(sources.items()), extra_cflags, extra_cuda_cflags, extra_ldflags, torch_cuda_arch_list
+    )
+    name = f"quantum_attn_tk_attention_dtype_{str(dtype).replace('torch.', '')}_is_fp8_{is_fp8}_{build_hash[:16]}"
+    build_directory = utils.get_build_directory(name)
+    module = utils.import_built_module(name, build_directory)
+    if module is not None:
+        return module
+
+    utils.write_sources(build_directory, sources)
+    return utils.build_module(
+        "load",
+        {"TORCH_CUDA_ARCH_LIST": torch_cuda_arch_list},
+        name=name,
+        sources=[os.path.join(build_directory, filename) for filename in sources if not filename.endswith(".cuh")],
+        extra_cflags=extra_cflags,
+        extra_cuda_cflags=extra_cuda_cflags,
+        extra_ldflags=extra_ldflags,
+        extra_include_paths=[utils.get_tk_include_dir()],
+        build_directory=build_directory,
+        verbose=True,
+    )
+
+
+def prewarm_tk_attention_modules(dtypes=(torch.float16, torch.bfloat16), is_fp8=(False, True)):
+    # one variant at a time, ninja already spreads the translation units of each build over all cores
+    for dtype, fp8 in itertools.product(dtypes, is_fp8):
+        load_tk_attention_module(dtype, fp8)
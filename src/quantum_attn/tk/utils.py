@@ -1,7 +1,109 @@
+import functools
+import hashlib
+import importlib.util
+import json
 import os
+import subprocess
+import sys
+import sysconfig
+import tempfile
+
+import torch
 
 import quantum_attn
 
 
 def get_tk_include_dir():
     return os.path.join(os.path.dirname(quantum_attn.__file__), "tk_repo", "include")
+
+
+@functools.cache
+def get_tk_include_digest():
+    h = hashlib.sha256()
+    include_dir = get_tk_include_dir()
+    for root, dirs, files in os.walk(include_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            h.update(os.path.relpath(path, include_dir).encode())
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def get_build_hash(*items):
+    h = hashlib.sha256()
+    for item in (
+        torch.__version__,
+        torch.version.cuda,
+        sys.version_info[:2],
+        sysconfig.get_config_var("EXT_SUFFIX"),
+        get_tk_include_digest(),
+        *items,
+    ):
+        h.update(repr(item).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def get_build_directory(name):
+    # same location load() would pick: honours TORCH_EXTENSIONS_DIR and the per python/cuda subfolder
+    from torch.utils.cpp_extension import _get_build_directory
+
+    return _get_build_directory(name, verbose=False)
+
+
+def write_sources(build_directory, sources):
+    for filename, source in sources.items():
+        path = os.path.join(build_directory, filename)
+        # keep the mtime of unchanged files so that ninja does not rebuild them
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.read() == source:
+                    continue
+        # the baton holder may be compiling the old file right now, swap the new one in instead of truncating it
+        fd, tmp_path = tempfile.mkstemp(dir=build_directory, prefix=f".{filename}.")
+        with os.fdopen(fd, "w") as f:
+            f.write(source)
+        os.replace(tmp_path, path)
+
+
+def get_module_path(name, build_directory):
+    from torch.utils.cpp_extension import LIB_EXT
+
+    return os.path.join(build_directory, f"{name}{LIB_EXT}")
+
+
+def import_module(name, build_directory):
+    spec = importlib.util.spec_from_file_location(name, get_module_path(name, build_directory))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def import_built_module(name, build_directory):
+    # a lock file means another process holds the build baton and may still be linking the library
+    if not os.path.exists(get_module_path(name, build_directory)) or os.path.exists(
+        os.path.join(build_directory, "lock")
+    ):
+        return None
+    return import_module(name, build_directory)
+
+
+def build_module(loader, env, **kwargs):
+    # cpp_extension reads some build settings only from os.environ, build in a child process
+    # so that env applies to this build alone and never leaks into other threads of this process
+    try:
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import json, sys; from torch.utils.cpp_extension import {loader}; {loader}(**json.loads(sys.argv[1]))",
+                json.dumps(kwargs),
+            ],
+            env={**os.environ, **env},
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Error building extension '{kwargs['name']}'") from e
+    return import_module(kwargs["name"], kwargs["build_directory"])
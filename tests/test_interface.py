@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 import quantum_attn
@@ -75,6 +77,30 @@ def test_attn_func(B, H, S_Q, S_KV, D, dtype, device, is_causal, force_eager_fal
     _test_attn_func(B, H, S_Q, S_KV, D, dtype, device, is_causal, force_eager_fallback)
 
 
+@pytest.mark.parametrize("B, S_Q, S_KV", [(0, 1024, 1024), (1, 0, 1024), (1, 1024, 0)])
+@pytest.mark.parametrize("D", [64, 128, 256])
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+@pytest.mark.parametrize("device", ["cuda"])
+@torch.no_grad()
+def test_attn_func_empty(B, S_Q, S_KV, D, dtype, device):
+    H = 8
+    query = torch.randn(B, H, S_Q, D, dtype=dtype, device=device)
+    key = torch.randn(B, H, S_KV, D, dtype=dtype, device=device)
+    value = torch.randn(B, H, S_KV, D, dtype=dtype, device=device)
+
+    try:
+        attn_out = vanilla_attention(query, key, value)
+    except ValueError as e:
+        if "Unsupported input" in str(e):
+            pytest.skip(str(e))
+        raise
+
+    with sdpa_kernel(SDPBackend.MATH):
+        attn_out_ref = F.scaled_dot_product_attention(query, key, value)
+
+    torch.testing.assert_close(attn_out, attn_out_ref)
+
+
 @pytest.mark.parametrize("B", [1, 2])
 @pytest.mark.parametrize("H", [8, 16])
 @pytest.mark.parametrize("S_Q", [1024, 1000])
@@ -89,6 +115,25 @@ def test_fp8_attn_func(B, H, S_Q, S_KV, D, dtype, device, is_causal, force_eager
     _test_attn_func(B, H, S_Q, S_KV, D, dtype, device, is_causal, force_eager_fallback, is_fp8=True)
 
 
+def test_prewarm_tk_attention_modules():
+    from quantum_attn.tk.attention import load_tk_attention_module, prewarm_tk_attention_modules
+
+    prewarm_tk_attention_modules(dtypes=())
+    prewarm_tk_attention_modules(dtypes=(torch.bfloat16,), is_fp8=(False,))
+    module = load_tk_attention_module(torch.bfloat16, False)
+    assert hasattr(module, "attention_forward")
+
+    misses = load_tk_attention_module.cache_info().misses
+    prewarm_tk_attention_modules(dtypes=(torch.bfloat16,), is_fp8=(False,))
+    assert load_tk_attention_module.cache_info().misses == misses
+
+    # a fresh process finds the built library on disk and does not rebuild it
+    mtime = os.path.getmtime(module.__file__)
+    load_tk_attention_module.cache_clear()
+    prewarm_tk_attention_modules(dtypes=(torch.bfloat16,), is_fp8=(False,))
+    assert os.path.getmtime(module.__file__) == mtime
+
+
 def _test_benchmark_attn_func(D, dtype, device, is_causal, is_fp8=False):
     import triton
 